@@ -4,197 +4,590 @@ Real-Time Chat Application
 Modern real-time chat application with WebSocket support, user authentication, and message history.
 """
 
-from flask import Flask, render_template_string, request, session, redirect, url_for
+# Monkey-patch the stdlib before anything else imports it so eventlet can
+# multiplex thousands of idle WebSocket connections on one OS thread.
+import eventlet
+eventlet.monkey_patch()
+
+from eventlet import tpool
+
+from flask import Flask, Response, request, session, redirect, url_for
 from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
+from socketio import packet as sio_packet
+from engineio import packet as eio_packet
+import os
+import queue
 import sqlite3
+import sys
 import hashlib
-import uuid
+import hmac
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
 from datetime import datetime
+from typing import NamedTuple
 import json
 
+import cachetools
+import msgspec
+import orjson
+from flask_compress import Compress
+from markupsafe import escape
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key-here'
-socketio = SocketIO(app, cors_allowed_origins="*")
+# For production run under an eventlet worker, e.g.:
+#   gunicorn -k eventlet -w 1 --worker-connections 10000 chat_app:app
+#
+# To scale past one worker, point SOCKETIO_MESSAGE_QUEUE at Redis
+# (e.g. redis://localhost:6379/0); the Redis adapter then pub/subs room
+# broadcasts across workers. Per-connection state (active_users,
+# room_members) stays process-local, so run multiple workers behind
+# sticky sessions. Ephemeral presence/typing events are emitted with
+# ignore_queue=True: they deliver to local sockets only and skip the
+# Redis round-trip, matching the process-local roster; durable chat
+# messages still fan out through the queue.
+# Chat text compresses several-fold; Brotli is preferred with gzip as
+# the universal fallback, and tiny responses are left alone.
+app.config['COMPRESS_ALGORITHM'] = ['br', 'gzip']
+app.config['COMPRESS_MIN_SIZE'] = 256
+Compress(app)
+
+class _OrJSON:
+    """Drop-in json module for python-socketio backed by orjson.
+
+    Socket.IO serializes every emit payload; orjson does the encode in C
+    and is several times faster than the stdlib for the small envelope
+    dicts this app sends. python-socketio expects a module-like object
+    with dumps returning str, hence the decode.
+    """
+
+    @staticmethod
+    def dumps(obj, *args, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return orjson.loads(data)
+
+
+socketio = SocketIO(app, async_mode='eventlet', cors_allowed_origins="*",
+                    json=_OrJSON,
+                    message_queue=os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+
+# SQL for the hot paths lives at module scope: pooled connections keep a
+# per-connection prepared-statement cache keyed by the SQL text, so
+# reusing the same string objects skips SQL-to-bytecode compilation.
+SQL_INSERT_USER = """
+    INSERT INTO users (username, email, password_hash, avatar_color, password_salt)
+    VALUES (?, ?, ?, ?, ?)
+"""
+
+SQL_SELECT_AUTH = """
+    SELECT id, username, email, avatar_color, password_hash, password_salt
+    FROM users
+    WHERE username = ?
+"""
+
+SQL_UPDATE_LAST_SEEN = """
+    UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = ?
+"""
+
+SQL_SELECT_USER = """
+    SELECT id, username, email, avatar_color
+    FROM users
+    WHERE id = ?
+"""
+
+SQL_INSERT_MSG = """
+    INSERT INTO messages (room_name, user_id, username, message, message_type, timestamp, avatar_color)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+SQL_SELECT_MSGS = """
+    SELECT * FROM (
+        SELECT id, username, message, message_type, timestamp, avatar_color
+        FROM messages
+        WHERE room_name = ? AND (? IS NULL OR id < ?)
+        ORDER BY id DESC
+        LIMIT ?
+    ) ORDER BY id ASC
+"""
+
+SQL_SELECT_ROOMS = """
+    SELECT room_name, room_description, created_at
+    FROM chat_rooms
+    WHERE is_private = 0
+    ORDER BY created_at
+"""
+
+# Outbound messages buffer per room for this long (or until the batch
+# cap) before being broadcast as one messages_batch event
+MSG_FLUSH_S = 0.05
+MSG_BATCH_MAX = 50
+
+# Per-sender token bucket: burst up to the cap, then sustained sends
+# are capped at the refill rate; excess messages are dropped
+MSG_RATE_CAP = 10.0
+MSG_RATE_PER_S = 5.0
+
+# Suppress duplicate typing broadcasts within this window per (sid, room)
+TYPING_DEBOUNCE_S = 2.0
+# Auto-broadcast stop_typing after this much keystroke silence
+TYPING_IDLE_S = 3.0
+
+
+class User(NamedTuple):
+    """Connected-user record handed to the event handlers.
+
+    A NamedTuple keeps field access at C level and costs roughly half a
+    dict per lookup; _asdict() produces the JSON-able view where a
+    payload needs one (orjson encodes tuples as arrays, not objects).
+    """
+    user_id: int
+    username: str
+    avatar_color: str
+
+
+class UserRegistry:
+    """Struct-of-arrays store for connected users.
+
+    Instead of a dict of per-user dicts (~220 B each), user fields live in
+    parallel arrays indexed through a sid map, so iterating many users
+    touches compact contiguous lists and removals reuse slots via a
+    free-list.
+    """
+
+    def __init__(self):
+        self._user_ids = []
+        self._usernames = []
+        self._colors = []
+        self._sid_to_idx = {}
+        self._free = []
+
+    def add(self, sid, user_id, username, avatar_color):
+        """Register a connected user under its socket sid."""
+        if self._free:
+            idx = self._free.pop()
+            self._user_ids[idx] = user_id
+            self._usernames[idx] = username
+            self._colors[idx] = avatar_color
+        else:
+            idx = len(self._user_ids)
+            self._user_ids.append(user_id)
+            self._usernames.append(username)
+            self._colors.append(avatar_color)
+        self._sid_to_idx[sid] = idx
+
+    def remove(self, sid):
+        """Drop a user, returning its slot to the free-list."""
+        idx = self._sid_to_idx.pop(sid, None)
+        if idx is not None:
+            self._user_ids[idx] = None
+            self._usernames[idx] = None
+            self._colors[idx] = None
+            self._free.append(idx)
+
+    def get(self, sid):
+        """Return the User record, or None if not connected."""
+        idx = self._sid_to_idx.get(sid)
+        if idx is None:
+            return None
+        return User(self._user_ids[idx], self._usernames[idx],
+                    self._colors[idx])
+
+    def __contains__(self, sid):
+        return sid in self._sid_to_idx
+
+    def __len__(self):
+        return len(self._sid_to_idx)
+
 
 class ChatApplication:
     """Real-time chat application with user management and message history."""
     
-    def __init__(self, db_path="chat.db"):
+    def __init__(self, db_path="chat.db", pool_size=None):
         self.db_path = db_path
+        if pool_size is None:
+            pool_size = int(os.environ.get('CHAT_DB_POOL_SIZE', '5'))
+        self._pool = queue.Queue(maxsize=pool_size)
+        for _ in range(pool_size):
+            self._pool.put(self._open_connection())
         self.init_database()
-        self.active_users = {}
+        self.active_users = UserRegistry()
         self.rooms = {'general': {'name': 'General', 'users': []}}
-    
+        # room -> {sid: user view}, maintained on join/leave so roster
+        # emits are a dict-values copy rather than a per-sid lookup scan
+        self.room_members = {}
+        # (sid, room) -> [last_keystroke, last_emit] monotonic timestamps
+        self.typing_state = {}
+        # sid -> [tokens, last_refill] send-rate buckets; eventlet's
+        # cooperative scheduling makes the read-modify-write safe unlocked
+        self.buckets = {}
+        # Outbound per-room message buffers awaiting a batched broadcast
+        self.pending = {}
+        self.pending_scheduled = set()
+        self.pending_lock = threading.Lock()
+        self._msg_queue = deque()
+        self._flush_lock = threading.Lock()
+        self._writer_started = False
+        self._user_cache = cachetools.LRUCache(maxsize=4096)
+        self._rooms_cache = cachetools.TTLCache(maxsize=1, ttl=30)
+
+    def room_sids(self, room):
+        """Return the room's sid->user mapping, or an empty tuple.
+
+        The empty-tuple default avoids allocating a fresh dict on every
+        lookup of a room nobody has joined.
+        """
+        return self.room_members.get(room) or ()
+
+    def _open_connection(self):
+        """Open a pooled connection with performance pragmas applied."""
+        conn = sqlite3.connect(self.db_path, check_same_thread=False,
+                               cached_statements=128)
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA busy_timeout=5000;
+            PRAGMA mmap_size=268435456;
+        """)
+        return conn
+
+    @contextmanager
+    def _conn(self):
+        """Borrow a connection from the pool and return it afterwards.
+
+        A connection must never go back to the pool with a transaction
+        still open — it would hold the WAL write lock and every later
+        write on any pooled connection would time out — so any
+        transaction left open when the block exits is rolled back.
+        """
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            self._pool.put(conn)
+
     def init_database(self):
         """Initialize the chat database."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        # Users table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                username TEXT UNIQUE NOT NULL,
-                email TEXT UNIQUE NOT NULL,
-                password_hash TEXT NOT NULL,
-                avatar_color TEXT DEFAULT '#667eea',
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_seen DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Chat rooms table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_rooms (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                room_name TEXT UNIQUE NOT NULL,
-                room_description TEXT,
-                created_by INTEGER,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                is_private BOOLEAN DEFAULT 0,
-                FOREIGN KEY (created_by) REFERENCES users(id)
-            )
-        """)
-        
-        # Messages table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                room_name TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                username TEXT NOT NULL,
-                message TEXT NOT NULL,
-                message_type TEXT DEFAULT 'text',
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(id)
-            )
-        """)
-        
-        # Create default room
-        cursor.execute("""
-            INSERT OR IGNORE INTO chat_rooms (room_name, room_description, created_by)
-            VALUES ('general', 'General discussion room', 1)
-        """)
-        
-        conn.commit()
-        conn.close()
+        with self._conn() as conn:
+            cursor = conn.cursor()
+
+            # Users table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS users (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    username TEXT UNIQUE NOT NULL,
+                    email TEXT UNIQUE NOT NULL,
+                    password_hash TEXT NOT NULL,
+                    avatar_color TEXT DEFAULT '#667eea',
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    last_seen DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    password_salt TEXT
+                )
+            """)
+
+            # Migrate databases created before salted password hashing
+            try:
+                cursor.execute("ALTER TABLE users ADD COLUMN password_salt TEXT")
+            except sqlite3.OperationalError:
+                pass
+
+            # Chat rooms table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS chat_rooms (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    room_name TEXT UNIQUE NOT NULL,
+                    room_description TEXT,
+                    created_by INTEGER,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    is_private BOOLEAN DEFAULT 0,
+                    FOREIGN KEY (created_by) REFERENCES users(id)
+                )
+            """)
+
+            # Messages table
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    room_name TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    username TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    message_type TEXT DEFAULT 'text',
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    avatar_color TEXT DEFAULT '#667eea',
+                    FOREIGN KEY (user_id) REFERENCES users(id)
+                )
+            """)
+
+            # Migrate databases created before avatar_color was denormalized
+            try:
+                cursor.execute("ALTER TABLE messages ADD COLUMN avatar_color TEXT DEFAULT '#667eea'")
+            except sqlite3.OperationalError:
+                pass
+
+            # History reads filter and keyset-paginate on id (the rowid),
+            # so the index pairs room_name with id: the newest-N inner
+            # query walks the index backwards and stops at LIMIT with no
+            # temp-B-tree sort. An earlier (room_name, timestamp) index
+            # could not satisfy ORDER BY id and forced that sort.
+            cursor.execute("DROP INDEX IF EXISTS idx_messages_room_ts")
+            cursor.execute("""
+                CREATE INDEX IF NOT EXISTS idx_messages_room_id
+                ON messages(room_name, id)
+            """)
+
+            # Messages are HTML-escaped once at send time and rendered
+            # with innerHTML; rows stored before that change hold raw
+            # text, so escape them once here. user_version marks the
+            # migration so escaped text is never escaped twice.
+            if cursor.execute("PRAGMA user_version").fetchone()[0] < 1:
+                cursor.execute("""
+                    UPDATE messages SET message =
+                        replace(replace(replace(replace(replace(message,
+                            '&', '&amp;'),
+                            '<', '&lt;'),
+                            '>', '&gt;'),
+                            '"', '&#34;'),
+                            '''', '&#39;')
+                """)
+                cursor.execute("PRAGMA user_version = 1")
+
+            # Create default room
+            cursor.execute("""
+                INSERT OR IGNORE INTO chat_rooms (room_name, room_description, created_by)
+                VALUES ('general', 'General discussion room', 1)
+            """)
+
+            conn.commit()
     
-    def hash_password(self, password):
-        """Hash password for secure storage."""
-        return hashlib.sha256(password.encode()).hexdigest()
+    def hash_password(self, password, salt):
+        """Hash password with scrypt for secure storage.
+
+        scrypt is deliberately slow, unlike the plain SHA-256 previously
+        used here; non-password hashing elsewhere should keep using
+        hashlib.sha256, which dispatches to CPU SHA extensions.
+        """
+        return hashlib.scrypt(password.encode(), salt=bytes.fromhex(salt),
+                              n=16384, r=8, p=1, dklen=32).hex()
     
     def create_user(self, username, email, password):
         """Create a new user account."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        try:
-            password_hash = self.hash_password(password)
-            avatar_colors = ['#667eea', '#764ba2', '#f093fb', '#f5576c', '#4facfe', '#43e97b']
-            avatar_color = avatar_colors[hash(username) % len(avatar_colors)]
-            
-            cursor.execute("""
-                INSERT INTO users (username, email, password_hash, avatar_color)
-                VALUES (?, ?, ?, ?)
-            """, (username, email, password_hash, avatar_color))
-            
-            conn.commit()
-            user_id = cursor.lastrowid
-            conn.close()
-            return user_id
-            
-        except sqlite3.IntegrityError:
-            conn.close()
-            return None
+        salt = os.urandom(16).hex()
+        # scrypt takes tens of ms by design; run it on the threadpool so
+        # the green thread keeps serving sockets, and before borrowing a
+        # connection so no pooled connection is pinned for the duration
+        password_hash = tpool.execute(self.hash_password, password, salt)
+        avatar_colors = ['#667eea', '#764ba2', '#f093fb', '#f5576c', '#4facfe', '#43e97b']
+        # crc32 is stable across processes, unlike hash() under
+        # PYTHONHASHSEED randomization, so every worker derives the
+        # same color for a given username
+        avatar_color = avatar_colors[zlib.crc32(username.encode()) % len(avatar_colors)]
+
+        with self._conn() as conn:
+            cursor = conn.cursor()
+
+            try:
+                cursor.execute(SQL_INSERT_USER,
+                               (username, email, password_hash, avatar_color, salt))
+
+                conn.commit()
+                return cursor.lastrowid
+
+            except sqlite3.IntegrityError:
+                # Discard the failed insert's open transaction before the
+                # connection goes back to the pool
+                conn.rollback()
+                return None
     
     def authenticate_user(self, username, password):
         """Authenticate user login."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        password_hash = self.hash_password(password)
-        cursor.execute("""
-            SELECT id, username, email, avatar_color
-            FROM users
-            WHERE username = ? AND password_hash = ?
-        """, (username, password_hash))
-        
-        user = cursor.fetchone()
-        
-        if user:
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(SQL_SELECT_AUTH, (username,))
+            row = cursor.fetchone()
+
+        if not row:
+            return None
+
+        # Hash outside the connection context: scrypt takes tens of ms,
+        # and holding a pooled connection across it starves the pool.
+        # The threadpool keeps the green thread serving sockets meanwhile.
+        stored_hash, salt = row[4], row[5]
+        if salt:
+            candidate = tpool.execute(self.hash_password, password, salt)
+        else:
+            # Account predates salted scrypt hashing
+            candidate = hashlib.sha256(password.encode()).hexdigest()
+
+        if not hmac.compare_digest(candidate, stored_hash):
+            return None
+
+        user = row[:4]
+
+        upgraded_hash = None
+        if not salt:
+            # Upgrade legacy accounts to scrypt on the fly
+            salt = os.urandom(16).hex()
+            upgraded_hash = tpool.execute(self.hash_password, password, salt)
+
+        with self._conn() as conn:
+            cursor = conn.cursor()
+            if upgraded_hash is not None:
+                cursor.execute("""
+                    UPDATE users SET password_hash = ?, password_salt = ? WHERE id = ?
+                """, (upgraded_hash, salt, user[0]))
             # Update last seen
-            cursor.execute("""
-                UPDATE users SET last_seen = CURRENT_TIMESTAMP WHERE id = ?
-            """, (user[0],))
+            cursor.execute(SQL_UPDATE_LAST_SEEN, (user[0],))
             conn.commit()
-        
-        conn.close()
+
+        # Drop any stale cached copy of this user
+        self._user_cache.pop(user[0], None)
         return user
     
     def get_user_by_id(self, user_id):
         """Get user information by ID."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT id, username, email, avatar_color
-            FROM users
-            WHERE id = ?
-        """, (user_id,))
-        
-        user = cursor.fetchone()
-        conn.close()
+        user = self._user_cache.get(user_id)
+        if user is not None:
+            return user
+
+        with self._conn() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(SQL_SELECT_USER, (user_id,))
+
+            user = cursor.fetchone()
+
+        if user is not None:
+            self._user_cache[user_id] = user
         return user
     
-    def save_message(self, room_name, user_id, username, message, message_type='text'):
-        """Save message to database."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            INSERT INTO messages (room_name, user_id, username, message, message_type)
-            VALUES (?, ?, ?, ?, ?)
-        """, (room_name, user_id, username, message, message_type))
-        
-        conn.commit()
-        message_id = cursor.lastrowid
-        conn.close()
-        return message_id
+    def save_message(self, room_name, user_id, username, message, message_type='text',
+                     avatar_color='#667eea', timestamp=None):
+        """Queue a message for the batched background writer.
+
+        timestamp is an epoch float (defaulting to now); it is formatted
+        to ISO text only when the batch is written, keeping clock
+        formatting off the hot send path while preserving arrival order.
+
+        Returns None: the row id is not known until the batch is
+        flushed. Callers needing real ids (e.g. keyset pagination) get
+        them from get_room_messages after a flush.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        self._msg_queue.append(
+            (room_name, user_id, username, message, message_type, timestamp, avatar_color))
+
+        if not self._writer_started:
+            self._writer_started = True
+            socketio.start_background_task(self._flush_loop)
+
+        return None
+
+    def flush_messages(self):
+        """Drain queued messages into SQLite in a single transaction."""
+        with self._flush_lock:
+            rows = []
+            # Cap the batch so one flush never holds the writer lock too long.
+            while self._msg_queue and len(rows) < 500:
+                rows.append(self._msg_queue.popleft())
+
+            if not rows:
+                return 0
+
+            # The executemany+commit blocks on disk I/O, so run it in the
+            # OS threadpool; the eventlet hub keeps servicing sockets
+            # while SQLite fsyncs. WAL mode means concurrent readers are
+            # never blocked by this writer. The connection is borrowed
+            # here, on the green thread: the pool is a green queue, and
+            # blocking on it from a tpool worker would park that worker
+            # on a hub that never runs.
+            try:
+                with self._conn() as conn:
+                    tpool.execute(self._write_rows, conn, rows)
+            except Exception:
+                # The rollback dropped the batch from the database, so
+                # put it back at the head of the queue (original order)
+                # to retry on the next flush rather than losing it
+                self._msg_queue.extendleft(reversed(rows))
+                raise
+
+            return len(rows)
+
+    def _write_rows(self, conn, rows):
+        """Insert a batch of message rows inside one transaction.
+
+        Runs on a tpool worker; the caller owns the pooled connection.
+        """
+        rows = [row[:5] + (datetime.fromtimestamp(row[5]).isoformat(sep=' '), row[6])
+                for row in rows]
+        # BEGIN IMMEDIATE takes the write lock up front so the batch
+        # cannot fail mid-way with SQLITE_BUSY after some inserts
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.executemany(SQL_INSERT_MSG, rows)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _flush_loop(self):
+        """Background task flushing the message queue every 50 ms."""
+        while True:
+            socketio.sleep(0.05)
+            try:
+                self.flush_messages()
+            except Exception:
+                # flush_messages re-queued the batch; keep the writer
+                # alive through transient errors (SQLITE_BUSY, disk
+                # full) and retry on the next tick
+                app.logger.exception("message flush failed; will retry")
     
-    def get_room_messages(self, room_name, limit=50):
-        """Get recent messages for a room."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT m.username, m.message, m.message_type, m.timestamp, u.avatar_color
-            FROM messages m
-            JOIN users u ON m.user_id = u.id
-            WHERE m.room_name = ?
-            ORDER BY m.timestamp DESC
-            LIMIT ?
-        """, (room_name, limit))
-        
-        messages = cursor.fetchall()
-        conn.close()
-        
-        # Reverse to show oldest first
-        return list(reversed(messages))
+    def get_room_messages(self, room_name, limit=50, before_id=None):
+        """Get recent messages for a room, oldest first.
+
+        before_id selects only messages older than the given message id,
+        enabling keyset pagination for "load older messages".
+        """
+        # Make sure queued messages are visible before reading history.
+        self.flush_messages()
+
+        with self._conn() as conn:
+            cursor = conn.cursor()
+
+            # The inner query takes the newest rows by indexed id; the
+            # outer one hands them back already ascending, so no Python
+            # reversal is needed. avatar_color is stored with each
+            # message, so no JOIN is needed either.
+            cursor.execute(SQL_SELECT_MSGS, (room_name, before_id, before_id, limit))
+
+            return cursor.fetchall()
     
     def get_available_rooms(self):
         """Get list of available chat rooms."""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT room_name, room_description, created_at
-            FROM chat_rooms
-            WHERE is_private = 0
-            ORDER BY created_at
-        """)
-        
-        rooms = cursor.fetchall()
-        conn.close()
+        # Rooms change rarely, so a short TTL cache absorbs the SELECT on
+        # every page load. Clear _rooms_cache if room creation is added.
+        rooms = self._rooms_cache.get('rooms')
+        if rooms is not None:
+            return rooms
+
+        with self._conn() as conn:
+            cursor = conn.cursor()
+
+            cursor.execute(SQL_SELECT_ROOMS)
+
+            rooms = cursor.fetchall()
+
+        self._rooms_cache['rooms'] = rooms
         return rooms
 
 chat_app = ChatApplication()
@@ -507,6 +900,7 @@ HTML_TEMPLATE = """
             avatar_color: '{{ user_avatar_color }}'
         };
         let currentRoom = 'general';
+        let onlineUsers = [];
         let typingTimer;
         let isTyping = false;
         
@@ -518,18 +912,18 @@ HTML_TEMPLATE = """
             console.log('Connected to server');
         });
         
-        socket.on('message', function(data) {
-            displayMessage(data);
+        socket.on('messages_batch', function(batch) {
+            batch.forEach(displayMessage);
         });
         
         socket.on('user_joined', function(data) {
-            displaySystemMessage(data.username + ' joined the room');
-            updateOnlineUsers(data.users);
+            displaySystemMessage(data.user.username + ' joined the room');
+            updateOnlineUsers(onlineUsers.concat([data.user]));
         });
         
         socket.on('user_left', function(data) {
             displaySystemMessage(data.username + ' left the room');
-            updateOnlineUsers(data.users);
+            updateOnlineUsers(onlineUsers.filter(u => u.username !== data.username));
         });
         
         socket.on('typing', function(data) {
@@ -584,7 +978,7 @@ HTML_TEMPLATE = """
                         <span class="message-username">${data.username}</span>
                         <span class="message-time">${timestamp}</span>
                     </div>
-                    <div class="message-text">${escapeHtml(data.message)}</div>
+                    <div class="message-text">${data.message}</div>
                 </div>
             `;
             
@@ -603,6 +997,7 @@ HTML_TEMPLATE = """
         }
         
         function updateOnlineUsers(users) {
+            onlineUsers = users;
             const onlineUsersList = document.getElementById('onlineUsersList');
             const onlineCount = document.getElementById('onlineCount');
             
@@ -650,22 +1045,16 @@ HTML_TEMPLATE = """
             indicator.style.display = 'none';
         }
         
-        function escapeHtml(text) {
-            const div = document.createElement('div');
-            div.textContent = text;
-            return div.innerHTML;
-        }
-        
         // Load message history
         fetch(`/api/messages/${currentRoom}`)
             .then(response => response.json())
             .then(messages => {
                 messages.forEach(msg => {
                     displayMessage({
-                        username: msg[0],
-                        message: msg[1],
-                        timestamp: msg[3],
-                        avatar_color: msg[4]
+                        username: msg.username,
+                        message: msg.message,
+                        timestamp: msg.ts,
+                        avatar_color: msg.color
                     });
                 });
             });
@@ -868,19 +1257,45 @@ LOGIN_TEMPLATE = """
 </html>
 """
 
+# Compile the login template once at import time; render_template_string
+# would re-run Jinja's lexer and parser on every request.
+_LOGIN_TMPL = app.jinja_env.from_string(LOGIN_TEMPLATE)
+
+# The chat page only ever interpolates the user's name and avatar color,
+# so skip Jinja entirely on that path: pre-render the template to bytes
+# with placeholder markers and fill them per request with bytes.replace.
+_INDEX_BYTES = (HTML_TEMPLATE
+                .replace('{{ user_username[0].upper() }}', '\x01INITIAL\x01')
+                .replace('{{ user_username }}', '\x01USER\x01')
+                .replace('{{ user_avatar_color }}', '\x01COLOR\x01')
+                .encode())
+
+def _render_index(username, avatar_color):
+    """Render the chat page by byte substitution instead of Jinja."""
+    return (_INDEX_BYTES
+            .replace(b'\x01INITIAL\x01', str(escape(username[:1].upper())).encode())
+            .replace(b'\x01USER\x01', str(escape(username)).encode())
+            .replace(b'\x01COLOR\x01', str(escape(avatar_color)).encode()))
+
 @app.route('/')
 def index():
     """Main chat page."""
     if 'user_id' not in session:
         return redirect(url_for('login'))
-    
-    user = chat_app.get_user_by_id(session['user_id'])
-    if not user:
-        return redirect(url_for('login'))
-    
-    return render_template_string(HTML_TEMPLATE, 
-                                user_username=user[1], 
-                                user_avatar_color=user[3])
+
+    username = session.get('username')
+    avatar_color = session.get('avatar_color')
+
+    if username is None or avatar_color is None:
+        # Sessions issued before these fields were stored at login
+        user = chat_app.get_user_by_id(session['user_id'])
+        if not user:
+            return redirect(url_for('login'))
+        username, avatar_color = user[1], user[3]
+        session['username'] = username
+        session['avatar_color'] = avatar_color
+
+    return Response(_render_index(username, avatar_color), mimetype='text/html')
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -896,9 +1311,10 @@ def login():
             if user:
                 session['user_id'] = user[0]
                 session['username'] = user[1]
+                session['avatar_color'] = user[3]
                 return redirect(url_for('index'))
             else:
-                return render_template_string(LOGIN_TEMPLATE, error="Invalid username or password")
+                return _LOGIN_TMPL.render(error="Invalid username or password")
         
         elif action == 'register':
             username = request.form.get('username')
@@ -907,11 +1323,11 @@ def login():
             
             user_id = chat_app.create_user(username, email, password)
             if user_id:
-                return render_template_string(LOGIN_TEMPLATE, success="Account created successfully! Please sign in.")
+                return _LOGIN_TMPL.render(success="Account created successfully! Please sign in.")
             else:
-                return render_template_string(LOGIN_TEMPLATE, error="Username or email already exists")
+                return _LOGIN_TMPL.render(error="Username or email already exists")
     
-    return render_template_string(LOGIN_TEMPLATE)
+    return _LOGIN_TMPL.render()
 
 @app.route('/logout')
 def logout():
@@ -925,124 +1341,304 @@ def get_messages(room_name):
     if 'user_id' not in session:
         return {'error': 'Not authenticated'}, 401
     
-    messages = chat_app.get_room_messages(room_name)
-    return messages
+    before_id = request.args.get('before', type=int)
+    messages = chat_app.get_room_messages(room_name, before_id=before_id)
+    # orjson serializes roughly 3-5x faster than stdlib json and emits
+    # bytes directly; dict rows keep the client decoupled from column order
+    payload = orjson.dumps([
+        {'id': m[0], 'username': m[1], 'message': m[2], 'ts': m[4], 'color': m[5]}
+        for m in messages
+    ])
+    return Response(payload, mimetype='application/json')
 
 # Socket.IO events
+# Ingress schemas for the socket events. msgspec.convert validates the
+# incoming dict in C, so malformed payloads are rejected up front
+# instead of raising KeyError mid-handler.
+class RoomMsg(msgspec.Struct):
+    room: str
+
+class SendMsg(msgspec.Struct):
+    room: str
+    message: str
+
+def _validated(data, schema):
+    """Convert an event payload to its schema, or None if malformed."""
+    try:
+        return msgspec.convert(data, schema)
+    except msgspec.ValidationError:
+        emit('error', {'message': 'malformed payload'})
+        return None
+
 @socketio.on('connect')
 def handle_connect():
-    """Handle user connection."""
+    """Handle user connection, rejecting anyone not logged in."""
     if 'user_id' not in session:
         return False
-    
+
     user = chat_app.get_user_by_id(session['user_id'])
-    if user:
-        chat_app.active_users[request.sid] = {
-            'user_id': user[0],
-            'username': user[1],
-            'avatar_color': user[3]
-        }
+    if user is None:
+        return False
+
+    chat_app.active_users.add(request.sid, user[0], user[1], user[3])
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle user disconnection."""
-    if request.sid in chat_app.active_users:
-        user_data = chat_app.active_users[request.sid]
-        
+    sid = request.sid
+    user_data = chat_app.active_users.get(sid)
+    if user_data is not None:
+        room_sids = chat_app.room_sids
+        payload = {'username': user_data.username}
+
         # Leave all rooms
         for room in rooms():
-            if room != request.sid:
+            if room != sid:
                 leave_room(room)
-                
-                # Get remaining users in room
-                room_users = [chat_app.active_users[sid] for sid in chat_app.active_users 
-                             if sid in socketio.server.manager.rooms.get('/', {}).get(room, set())]
-                
-                emit('user_left', {
-                    'username': user_data['username'],
-                    'users': room_users
-                }, room=room)
-        
-        del chat_app.active_users[request.sid]
+                members = room_sids(room)
+                if members:
+                    members.pop(sid, None)
+                    # Room names are client-supplied and disconnect is
+                    # the only cleanup point, so drop emptied rooms or
+                    # the map grows without bound
+                    if not members:
+                        chat_app.room_members.pop(room, None)
+
+                # Send only the departing username; clients maintain their
+                # own roster, so no O(room) user list is rebuilt here
+                socketio.server.emit('user_left', payload, room=room,
+                                     namespace='/', ignore_queue=True)
+
+        chat_app.active_users.remove(sid)
+        chat_app.buckets.pop(sid, None)
 
 @socketio.on('join_room')
 def handle_join_room(data):
     """Handle user joining a room."""
-    if request.sid not in chat_app.active_users:
+    user_data = chat_app.active_users.get(request.sid)
+    if user_data is None:
         return
-    
-    room = data['room']
-    user_data = chat_app.active_users[request.sid]
-    
+
+    req = _validated(data, RoomMsg)
+    if req is None:
+        return
+    room = req.room
+
     join_room(room)
-    
-    # Get all users in room
-    room_users = [chat_app.active_users[sid] for sid in chat_app.active_users 
-                 if sid in socketio.server.manager.rooms.get('/', {}).get(room, set())]
-    
-    # Notify others
-    emit('user_joined', {
-        'username': user_data['username'],
-        'users': room_users
-    }, room=room, include_self=False)
-    
-    # Send room users to the joining user
+    # Store the JSON-able view; the membership map feeds emit payloads
+    user_view = user_data._asdict()
+    members = chat_app.room_members.setdefault(room, {})
+    members[request.sid] = user_view
+
+    # The membership map already stores each member's view, so the
+    # roster is a values copy with no per-sid registry lookups
+    room_users = list(members.values())
+
+    # Notify others with just the delta; broadcasting the full roster to
+    # every member would cost O(room^2) bytes per join. skip_sid excludes
+    # the sender inside the delivery loop instead of materializing a
+    # filtered recipient list first.
+    socketio.server.emit('user_joined', {
+        'user': user_view
+    }, room=room, skip_sid=request.sid, namespace='/', ignore_queue=True)
+
+    # Only the joining user needs the full roster
     emit('room_users', {'users': room_users})
 
+def _flush_room(room):
+    """Broadcast a room's buffered messages as one batch event."""
+    socketio.sleep(MSG_FLUSH_S)
+    with chat_app.pending_lock:
+        batch = chat_app.pending.pop(room, None)
+        chat_app.pending_scheduled.discard(room)
+    if batch:
+        _broadcast_batch(room, batch)
+        # Persist the same burst with one executemany/commit instead of
+        # waiting for the writer loop's next tick
+        chat_app.flush_messages()
+
+def _finalize_batch(batch):
+    """Convert raw epoch ts fields to the ISO timestamps clients expect."""
+    for envelope in batch:
+        envelope['timestamp'] = datetime.fromtimestamp(envelope.pop('ts')).isoformat()
+    return batch
+
+_USE_MESSAGE_QUEUE = bool(os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+
+def _broadcast_batch(room, batch):
+    """Send a room's messages_batch, encoding the payload only once.
+
+    The stock emit path rebuilds and re-encodes the Socket.IO packet for
+    every recipient; here both the Socket.IO and engine.io packets are
+    constructed once and the same encoded buffer is handed to each
+    member's transport, so fanout cost is one JSON encode regardless of
+    room size. Falls back to the regular emit when a cross-worker
+    message queue is configured (remote workers need the pub/sub copy)
+    or the fast path raises.
+    """
+    data = _finalize_batch(batch)
+    if not _USE_MESSAGE_QUEUE:
+        try:
+            encoded = sio_packet.Packet(sio_packet.EVENT, namespace='/',
+                                        data=['messages_batch', data]).encode()
+            pkt = eio_packet.Packet(eio_packet.MESSAGE, data=encoded)
+            srv = socketio.server
+            eio_sid_of = srv.manager.eio_sid_from_sid
+            for sid in chat_app.room_sids(room):
+                eio_sid = eio_sid_of(sid, '/')
+                if eio_sid is not None:
+                    srv._send_eio_packet(eio_sid, pkt)
+            return
+        except Exception:
+            pass
+    socketio.emit('messages_batch', data, room=room)
+
 @socketio.on('send_message')
-def handle_send_message(data):
-    """Handle sending a message."""
-    if request.sid not in chat_app.active_users:
+def handle_send_message(data, _users=chat_app.active_users,
+                        _buckets=chat_app.buckets,
+                        _monotonic=time.monotonic, _time=time.time):
+    """Handle sending a message.
+
+    The default args bind hot references once at import time, so the
+    per-message path resolves them as locals instead of paying a
+    global-plus-attribute lookup for each.
+    """
+    user_data = _users.get(request.sid)
+    if user_data is None:
         return
-    
-    user_data = chat_app.active_users[request.sid]
-    room = data['room']
-    message = data['message']
-    
+
+    # Refill the sender's token bucket, then spend one token; flooding
+    # clients run dry and their excess messages are dropped before any
+    # escaping, DB write or broadcast happens
+    mono = _monotonic()
+    bucket = _buckets.get(request.sid)
+    if bucket is None:
+        bucket = _buckets[request.sid] = [MSG_RATE_CAP, mono]
+    else:
+        bucket[0] = min(MSG_RATE_CAP,
+                        bucket[0] + (mono - bucket[1]) * MSG_RATE_PER_S)
+        bucket[1] = mono
+    if bucket[0] < 1.0:
+        emit('rate_limited',
+             {'retry_after': (1.0 - bucket[0]) / MSG_RATE_PER_S})
+        return
+    bucket[0] -= 1.0
+
+    req = _validated(data, SendMsg)
+    if req is None:
+        return
+    room = req.room
+    # Escape once on the server; every recipient and later history loads
+    # reuse the same escaped text instead of re-escaping client-side
+    message = str(escape(req.message))
+
+    username = user_data.username
+    avatar_color = user_data.avatar_color
+    # One clock read per message; ISO formatting happens at flush time
+    ts = _time()
+
     # Save message to database
-    chat_app.save_message(room, user_data['user_id'], user_data['username'], message)
-    
-    # Broadcast message to room
-    emit('message', {
-        'username': user_data['username'],
+    chat_app.save_message(room, user_data.user_id, username, message,
+                          avatar_color=avatar_color, timestamp=ts)
+
+    envelope = {
+        'username': username,
         'message': message,
-        'timestamp': datetime.now().isoformat(),
-        'avatar_color': user_data['avatar_color']
-    }, room=room)
+        'ts': ts,
+        'avatar_color': avatar_color
+    }
+
+    # Buffer the message; one messages_batch broadcast covers everything
+    # the room produced within the flush window, keeping per-room order
+    flush_now = None
+    with chat_app.pending_lock:
+        batch = chat_app.pending.setdefault(room, [])
+        batch.append(envelope)
+        if len(batch) >= MSG_BATCH_MAX:
+            flush_now = chat_app.pending.pop(room)
+            chat_app.pending_scheduled.discard(room)
+        elif room not in chat_app.pending_scheduled:
+            chat_app.pending_scheduled.add(room)
+            socketio.start_background_task(_flush_room, room)
+
+    if flush_now is not None:
+        _broadcast_batch(room, flush_now)
+
+def _typing_watchdog(key, room):
+    """Emit stop_typing once the sender has been idle long enough."""
+    sid = key[0]
+    while True:
+        socketio.sleep(0.5)
+        state = chat_app.typing_state.get(key)
+        if state is None:
+            return
+        if time.monotonic() - state[0] >= TYPING_IDLE_S:
+            chat_app.typing_state.pop(key, None)
+            socketio.server.emit('stop_typing', {}, room=room, skip_sid=sid,
+                                 namespace='/', ignore_queue=True)
+            return
 
 @socketio.on('typing')
-def handle_typing(data):
-    """Handle typing indicator."""
-    if request.sid not in chat_app.active_users:
+def handle_typing(data, _users=chat_app.active_users,
+                  _state=chat_app.typing_state, _monotonic=time.monotonic):
+    """Handle typing indicator (per-keystroke, so locals bound as above)."""
+    user_data = _users.get(request.sid)
+    if user_data is None:
         return
-    
-    user_data = chat_app.active_users[request.sid]
-    room = data['room']
-    
-    emit('typing', {
-        'username': user_data['username']
-    }, room=room, include_self=False)
+
+    req = _validated(data, RoomMsg)
+    if req is None:
+        return
+    room = req.room
+    key = (request.sid, room)
+    now = _monotonic()
+    state = _state.get(key)
+
+    if state is not None:
+        # Refresh activity; drop the broadcast if one went out recently
+        state[0] = now
+        if now - state[1] < TYPING_DEBOUNCE_S:
+            return
+        state[1] = now
+    else:
+        _state[key] = [now, now]
+        # One watchdog per (sid, room) replaces per-keystroke stop_typing
+        socketio.start_background_task(_typing_watchdog, key, room)
+
+    socketio.server.emit('typing', {
+        'username': user_data.username
+    }, room=room, skip_sid=request.sid, namespace='/', ignore_queue=True)
 
 @socketio.on('stop_typing')
-def handle_stop_typing(data):
-    """Handle stop typing indicator."""
-    if request.sid not in chat_app.active_users:
+def handle_stop_typing(data, _users=chat_app.active_users,
+                       _state=chat_app.typing_state):
+    """Handle stop typing indicator (fast-cancel before the watchdog)."""
+    if request.sid not in _users:
         return
-    
-    room = data['room']
-    emit('stop_typing', {}, room=room, include_self=False)
+
+    req = _validated(data, RoomMsg)
+    if req is None:
+        return
+    room = req.room
+    if _state.pop((request.sid, room), None) is not None:
+        socketio.server.emit('stop_typing', {}, room=room,
+                             skip_sid=request.sid, namespace='/',
+                             ignore_queue=True)
 
 def main():
     """Main execution function."""
-    print("Real-Time Chat Application")
-    print("=" * 30)
-    
-    print("Initializing chat system...")
-    print("Setting up database...")
-    print("Starting web server...")
-    print("Open http://localhost:5000 in your browser")
-    
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    # One write/flush for the whole banner instead of five print calls,
+    # each of which flushes separately on line-buffered pipes
+    sys.stdout.write(
+        "Real-Time Chat Application\n"
+        + "=" * 30 + "\n"
+        "Initializing chat system...\n"
+        "Setting up database...\n"
+        "Starting web server...\n"
+        "Open http://localhost:5000 in your browser\n"
+    )
+
+    socketio.run(app, debug=False, host='0.0.0.0', port=5000)
 
 if __name__ == "__main__":
     main()
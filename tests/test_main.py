@@ -35,6 +35,81 @@ class TestProjectStructure:
         lic = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "LICENSE")
         assert os.path.isfile(lic), "LICENSE should exist"
 
+class TestAuthentication:
+    """Tests for user creation and password verification."""
+
+    @pytest.fixture
+    def chat(self, tmp_path):
+        if not HAS_CHAT_APP:
+            pytest.skip("chat_app not importable")
+        return chat_app.ChatApplication(db_path=str(tmp_path / "test.db"))
+
+    def test_create_and_authenticate_user(self, chat):
+        """Test that a created user can log in."""
+        user_id = chat.create_user("alice", "alice@example.com", "secret")
+        assert user_id is not None
+        user = chat.authenticate_user("alice", "secret")
+        assert user is not None
+        assert user[1] == "alice"
+
+    def test_duplicate_username_does_not_poison_pool(self, chat):
+        """Test that writes still work after a duplicate registration."""
+        chat.create_user("alice", "alice@example.com", "secret")
+        assert chat.create_user("alice", "other@example.com", "pw") is None
+        user = chat.authenticate_user("alice", "secret")
+        assert user is not None
+
+    def test_wrong_password_rejected(self, chat):
+        """Test that a wrong password fails authentication."""
+        chat.create_user("bob", "bob@example.com", "secret")
+        assert chat.authenticate_user("bob", "wrong") is None
+
+    def test_avatar_color_is_deterministic(self, chat):
+        """Test that the same username always gets the same color."""
+        user_id = chat.create_user("erin", "erin@example.com", "secret")
+        expected = chat.get_user_by_id(user_id)[3]
+        import zlib
+        colors = ['#667eea', '#764ba2', '#f093fb', '#f5576c', '#4facfe', '#43e97b']
+        assert expected == colors[zlib.crc32(b"erin") % len(colors)]
+
+    def test_passwords_are_salted(self, chat):
+        """Test that identical passwords produce different hashes."""
+        chat.create_user("carol", "carol@example.com", "secret")
+        chat.create_user("dave", "dave@example.com", "secret")
+        with chat._conn() as conn:
+            hashes = [r[0] for r in conn.execute(
+                "SELECT password_hash FROM users ORDER BY id")]
+        assert hashes[0] != hashes[1]
+
+
+class TestMessageHistory:
+    """Tests for message persistence and pagination."""
+
+    @pytest.fixture
+    def chat(self, tmp_path):
+        if not HAS_CHAT_APP:
+            pytest.skip("chat_app not importable")
+        return chat_app.ChatApplication(db_path=str(tmp_path / "test.db"))
+
+    def test_messages_returned_oldest_first(self, chat):
+        """Test that history comes back in ascending order."""
+        user_id = chat.create_user("alice", "alice@example.com", "secret")
+        for i in range(3):
+            chat.save_message("general", user_id, "alice", f"msg{i}")
+        messages = chat.get_room_messages("general")
+        assert [m[2] for m in messages] == ["msg0", "msg1", "msg2"]
+
+    def test_keyset_pagination(self, chat):
+        """Test that before_id pages backwards through history."""
+        user_id = chat.create_user("alice", "alice@example.com", "secret")
+        for i in range(5):
+            chat.save_message("general", user_id, "alice", f"msg{i}")
+        latest = chat.get_room_messages("general", limit=2)
+        assert [m[2] for m in latest] == ["msg3", "msg4"]
+        older = chat.get_room_messages("general", limit=2, before_id=latest[0][0])
+        assert [m[2] for m in older] == ["msg1", "msg2"]
+
+
 class TestChatApp:
     """Tests for chat_app module."""
     